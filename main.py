@@ -1,15 +1,19 @@
 import os
-import re
 import time
 import asyncio
+import collections
+import logging
 import tempfile
 import sqlite3
-import math
+import threading
 from typing import Dict, Any
 
 import io
+import aiofiles
 import aiohttp
+from cachetools import TTLCache
 from aiogram import Bot, Dispatcher
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup,
@@ -19,16 +23,43 @@ from yandex_music import ClientAsync
 from mutagen.id3 import ID3, TPE1, TIT2, APIC
 from PIL import Image
 
+logger = logging.getLogger(__name__)
+
 # === КОНФИГУРАЦИЯ ===
-invoices = {}   
+# TTLCache вместо dict: иначе каждый когда-либо писавший пользователь
+# (вместе с aiogram-объектами Message) остаётся в памяти навсегда
+invoices = TTLCache(maxsize=10_000, ttl=600)
 try:
     BOT_TOKEN = os.getenv("BOT_TOKEN")
     YM_TOKEN = os.getenv("YM_TOKEN")
 except ImportError:
     raise SystemExit(1)
 
+def _default_temp_dir() -> str:
+    # tmpfs: запись и последующее чтение mp3 при аплоаде идут через page cache, минуя диск
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+# Каталог временных файлов: настраиваемый, чтобы держать его на одной ФС с
+# финальными/кэшевыми путями — тогда os.replace атомарен и без копий между устройствами
+CACHE_DIR = os.getenv("YMBOT_CACHE") or _default_temp_dir()
+
 # Параметры подписки и БД
 SUBSCRIPTIONS_DB = "subscriptions.db"
+
+# Одно постоянное соединение с БД вместо открытия на каждый запрос.
+# Запись сериализуем локом, чтение из WAL безопасно без него.
+db_conn: sqlite3.Connection | None = None
+db_write_lock = threading.Lock()
+
+# Кэш подписок user_id -> expires_at, чтобы не ходить в SQLite на каждое нажатие кнопки
+_sub_cache: Dict[int, int] = {}
+# Отрицательный кэш: user_id без подписки -> когда перепроверить в БД.
+# Иначе каждый клик неподписчика — это SELECT
+_nonsub_cache: Dict[int, int] = {}
+NONSUB_CACHE_TTL = 60
 SUBSCRIBE_PRICE_STARS = 50
 SUBSCRIBE_DURATION_DAYS = 30
 
@@ -41,72 +72,117 @@ ym_client = None
 # Добавлено: сохранение id бота для проверки reply_to_message
 BOT_ID: int | None = None
 
-user_states: Dict[int, Dict[str, Any]] = {}
+user_states: TTLCache = TTLCache(maxsize=50_000, ttl=1800)
 
 # === УПРАВЛЕНИЕ ЗАГРУЗКАМИ И ПОДПИСЧИКАМИ ===
-download_queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+# Две FIFO-очереди вместо кучи: приоритетов всего два, а подписчик,
+# пришедший позже, не должен ждать уже накопившиеся обычные задачи
+prio_queue: collections.deque = collections.deque()
+norm_queue: collections.deque = collections.deque()
+prio_event = asyncio.Event()
+norm_event = asyncio.Event()
 MAX_CONCURRENT_DOWNLOADS = 10
+# Слоты, зарезервированные под подписчиков (priority == 0)
+SUBSCRIBER_RESERVED_SLOTS = 3
+download_slots = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+# Обычные загрузки не могут занять весь пул — подписчикам всегда остаётся резерв
+normal_slots = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS - SUBSCRIBER_RESERVED_SLOTS)
+
+# Общая HTTP-сессия (keep-alive, DNS-кэш) вместо новой на каждый запрос; создаётся в main()
+http_session: aiohttp.ClientSession | None = None
+
+# Кэши по track_id: популярные треки запрашивают разные пользователи подряд.
+# Метаданные/обложка живут недолго, прямые ссылки Яндекса протухают ~через час.
+# TTLCache ограничивает и размер: старые треки вытесняются, RSS не растёт.
+TRACK_META_TTL = 600
+DIRECT_LINK_TTL = 3300
+_track_meta_cache: TTLCache = TTLCache(maxsize=1000, ttl=TRACK_META_TTL)    # track_id -> (track_info, cover_data)
+_direct_link_cache: TTLCache = TTLCache(maxsize=2000, ttl=DIRECT_LINK_TTL)  # track_id -> direct_link
+
+# Популярные поисковые запросы повторяются постоянно; выдача стабильна минутами.
+# Храним только топ-5 треков, а не весь объект ответа, чтобы не раздувать память
+search_cache: TTLCache = TTLCache(maxsize=5000, ttl=300)
+# Ограничиваем одновременные обращения к CDN (обложки + mp3)
+DOWNLOAD_SEM = asyncio.Semaphore(16)
 
 
 def init_db():
-    conn = sqlite3.connect(SUBSCRIPTIONS_DB)
-    try:
-        c = conn.cursor()
-        c.execute(
-            """CREATE TABLE IF NOT EXISTS subscriptions
-               (
-                   user_id
-                   INTEGER
-                   PRIMARY
-                   KEY,
-                   expires_at
-                   INTEGER
-               )"""
-        )
-        conn.commit()
-    finally:
-        conn.close()
+    global db_conn
+    db_conn = sqlite3.connect(SUBSCRIPTIONS_DB, check_same_thread=False, isolation_level=None)
+    # WAL + ослабленный fsync: нет пересоздания page cache и fsync на каждый COMMIT
+    db_conn.execute("PRAGMA journal_mode=WAL")
+    db_conn.execute("PRAGMA busy_timeout=5000")
+    db_conn.execute("PRAGMA synchronous=NORMAL")
+    db_conn.execute("PRAGMA temp_store=memory")
+    db_conn.execute("PRAGMA cache_size=-64000")
+    db_conn.execute(
+        """CREATE TABLE IF NOT EXISTS subscriptions
+           (
+               user_id
+               INTEGER
+               PRIMARY
+               KEY,
+               expires_at
+               INTEGER
+           )"""
+    )
+    # Telegram file_id уже загруженных треков: повторная отправка без скачивания
+    db_conn.execute(
+        """CREATE TABLE IF NOT EXISTS tracks
+           (
+               track_id
+               INTEGER
+               PRIMARY
+               KEY,
+               file_id
+               TEXT,
+               created_at
+               INTEGER
+           )"""
+    )
 
 
 def add_subscription(user_id: int, days: int = SUBSCRIBE_DURATION_DAYS) -> None:
     now = int(time.time())
-    conn = sqlite3.connect(SUBSCRIPTIONS_DB)
-    try:
-        c = conn.cursor()
-        c.execute("SELECT expires_at FROM subscriptions WHERE user_id = ?", (user_id,))
-        row = c.fetchone()
-        if row and int(row[0]) > now:
-            # продлеваем от текущего expires_at
-            current_expires = int(row[0])
-            new_expires = current_expires + days * 86400
-            c.execute("UPDATE subscriptions SET expires_at = ? WHERE user_id = ?", (new_expires, user_id))
-        else:
-            # новая подписка от текущего момента
-            new_expires = now + days * 86400
-            c.execute("INSERT OR REPLACE INTO subscriptions (user_id, expires_at) VALUES (?, ?)",
-                      (user_id, new_expires))
-        conn.commit()
-    finally:
-        conn.close()
+    extension = days * 86400
+    with db_write_lock:
+        # Один UPSERT вместо SELECT + ветвления в Python: активная подписка
+        # продлевается от текущего expires_at, истёкшая/новая — от текущего момента
+        row = db_conn.execute(
+            "INSERT INTO subscriptions (user_id, expires_at) VALUES (?1, ?2 + ?3) "
+            "ON CONFLICT(user_id) DO UPDATE SET expires_at = "
+            "CASE WHEN expires_at > ?2 THEN expires_at + ?3 ELSE ?2 + ?3 END "
+            "RETURNING expires_at",
+            (user_id, now, extension)).fetchone()
+    _sub_cache[user_id] = int(row[0])
+    _nonsub_cache.pop(user_id, None)
 
 
 def get_subscription_days_left(user_id: int) -> int:
-    conn = sqlite3.connect(SUBSCRIPTIONS_DB)
-    try:
-        c = conn.cursor()
-        c.execute("SELECT expires_at FROM subscriptions WHERE user_id = ?", (user_id,))
-        row = c.fetchone()
-    finally:
-        conn.close()
+    now = int(time.time())
+
+    expires_at = _sub_cache.get(user_id)
+    if expires_at is not None and expires_at > now:
+        return (expires_at - now + 86399) // 86400
+
+    recheck_at = _nonsub_cache.get(user_id)
+    if recheck_at is not None and recheck_at > now:
+        return 0
+
+    row = db_conn.execute(
+        "SELECT expires_at FROM subscriptions WHERE user_id = ?", (user_id,)
+    ).fetchone()
 
     if not row:
+        _nonsub_cache[user_id] = now + NONSUB_CACHE_TTL
         return 0
     expires_at = int(row[0])
-    now = int(time.time())
+    _sub_cache[user_id] = expires_at
     if expires_at <= now:
+        _nonsub_cache[user_id] = now + NONSUB_CACHE_TTL
         return 0
-    seconds_left = expires_at - now
-    days_left = math.ceil(seconds_left / 86400)
+    # Целочисленный ceil без float-конверсий
+    days_left = (expires_at - now + 86399) // 86400
     return days_left
 
 
@@ -114,93 +190,297 @@ def is_subscribed(user_id: int) -> bool:
     return get_subscription_days_left(user_id) > 0
 
 
+def get_cached_file_id(track_id: int) -> str | None:
+    row = db_conn.execute("SELECT file_id FROM tracks WHERE track_id = ?", (track_id,)).fetchone()
+    return row[0] if row else None
+
+
+def save_file_id(track_id: int, file_id: str) -> None:
+    with db_write_lock:
+        db_conn.execute(
+            "INSERT OR REPLACE INTO tracks (track_id, file_id, created_at) VALUES (?, ?, ?)",
+            (track_id, file_id, int(time.time())))
+
+
+async def sub_cache_evictor():
+    # Периодически выкидываем давно истёкшие подписки из кэша
+    while True:
+        await asyncio.sleep(3600)
+        cutoff = int(time.time()) - 3600
+        # list(...items()) — атомарный снимок: кэши пишутся и из тредов to_thread,
+        # итерация по «живому» dict упала бы на конкурентной вставке
+        for user_id, exp in list(_sub_cache.items()):
+            if exp < cutoff:
+                _sub_cache.pop(user_id, None)
+        for user_id, ts in list(_nonsub_cache.items()):
+            if ts < cutoff:
+                _nonsub_cache.pop(user_id, None)
+
+
+# === ОГРАНИЧЕНИЕ ЧАСТОТЫ ОТПРАВКИ В TELEGRAM ===
+class TelegramTokenBucket:
+    """
+    Общий token bucket на все исходящие вызовы Bot API.
+    Telegram разрешает ~30 msg/s на бота; держим чуть ниже лимита,
+    а при 429 (retry_after) ставим на паузу сразу все корутины.
+    """
+
+    def __init__(self, rate: float = 25.0, burst: int = 30):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._resume = asyncio.Event()
+        self._resume.set()
+
+    async def acquire(self) -> None:
+        await self._resume.wait()
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Токен списываем безусловно: при исчерпании баланс уходит в минус,
+            # и каждый следующий ожидающий спит дольше — долг не забывается
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def pause(self, seconds: float) -> None:
+        # Глобальная пауза после retry_after: все ждут Event, без busy-poll
+        if not self._resume.is_set():
+            return
+        self._resume.clear()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self._resume.set()
+
+
+tg_bucket = TelegramTokenBucket()
+
+# Держим ссылки на fire-and-forget задачи, чтобы GC не прибил их до завершения
+_bg_tasks: set = set()
+
+
+def spawn_bg(coro) -> None:
+    task = asyncio.create_task(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+
+
+async def safe_tg(make_call):
+    """
+    Вызов Bot API с уважением к flood control: при 429 ставим общий bucket
+    на паузу на retry_after и повторяем вызов один раз.
+    make_call — фабрика корутины (корутину нельзя await'ить дважды).
+    """
+    try:
+        return await make_call()
+    except TelegramRetryAfter as e:
+        await tg_bucket.pause(e.retry_after)
+        return await make_call()
+
+
 # === ОСНОВНЫЕ ФУНКЦИИ БОТА ===
+_MB = 1.0 / (1024 * 1024)
+
+_FILENAME_BAD_CHARS = str.maketrans('', '', '\\/*?:"<>|')
+
+
 def sanitize_filename(filename: str) -> str:
-    return re.sub(r'[\/*?:"<>|]', "", filename)
+    return filename.translate(_FILENAME_BAD_CHARS)
 
 
 async def edit_progress_message(chat_id: int, message_id: int, text: str) -> None:
     try:
+        await tg_bucket.acquire()
         await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
-    except:
-        pass
+    except TelegramRetryAfter as e:
+        await tg_bucket.pause(e.retry_after)
+    except TelegramBadRequest:
+        pass  # сообщение удалено или текст не изменился
+
+
+# Шаблон кнопки «Удалить»: при отправке меняем только callback_data
+_DELETE_BUTTON = InlineKeyboardButton(text="Удалить", callback_data="delete_0")
 
 
 async def add_action_buttons(chat_id: int, message_id: int, title: str) -> None:
     markup = InlineKeyboardMarkup(inline_keyboard=[
-         [InlineKeyboardButton(text="Удалить", callback_data=f"delete_{message_id}")]
+         [_DELETE_BUTTON.model_copy(update={"callback_data": f"delete_{message_id}"})]
     ])
     try:
+        await tg_bucket.acquire()
         await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=markup)
-    except:
+    except TelegramRetryAfter as e:
+        await tg_bucket.pause(e.retry_after)
+    except TelegramBadRequest:
         pass
 
 
+async def delete_message_silent(chat_id: int, message_id: int) -> None:
+    try:
+        await tg_bucket.acquire()
+        await bot.delete_message(chat_id, message_id)
+    except TelegramRetryAfter as e:
+        await tg_bucket.pause(e.retry_after)
+    except TelegramBadRequest:
+        pass  # уже удалено
+
+
 def add_tags_to_audio_blocking(filename: str, title: str, artists: str, cover_data: bytes) -> None:
+    # Ужимаем обложку перед встраиванием: меньше APIC — меньше байт на перезапись
+    # файла mutagen'ом и на аплоад в Telegram
+    try:
+        img = Image.open(io.BytesIO(cover_data))
+        img = img.convert("RGB")
+        img.thumbnail((300, 300), Image.LANCZOS)
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=80, optimize=True)
+        cover_data = buf.getvalue()
+    except (OSError, ValueError):
+        # битый/неподдерживаемый JPEG — встраиваем как есть
+        logger.exception("Не удалось ужать обложку")
+
     audio = ID3()
     audio.add(TPE1(encoding=3, text=artists))
     audio.add(TIT2(encoding=3, text=title))
     audio.add(APIC(encoding=3, mime="image/jpeg", type=3, desc="Cover", data=cover_data))
-    audio.save(filename)
+    # Резервируем паддинг с запасом под обложку: даже замена APIC позже
+    # уложится в него, и mutagen перепишет тег на месте, а не весь файл
+    audio.save(filename, v2_version=3, padding=lambda info: max(info.padding, len(cover_data) + 4096))
 
 
 async def add_tags_to_audio(filename: str, title: str, artists: str, cover_data: bytes) -> None:
     await asyncio.to_thread(add_tags_to_audio_blocking, filename, title, artists, cover_data)
 
 
+async def fetch_cover(cover_url: str) -> bytes:
+    async with DOWNLOAD_SEM:
+        async with http_session.get(cover_url) as resp:
+            resp.raise_for_status()
+            return await resp.read()
+
+
+async def progress_writer(chat_id: int, message_id: int, state: Dict[str, Any], updated: asyncio.Event) -> None:
+    """
+    Единственный писатель прогресса на загрузку: забирает из state последний
+    текст и шлёт его в Telegram. Цикл скачивания только обновляет state и
+    дёргает event, поэтому никогда не ждёт RTT Telegram.
+    """
+    while True:
+        await updated.wait()
+        updated.clear()
+        text = state.pop("latest_text", None)
+        if text is not None:
+            await edit_progress_message(chat_id, message_id, text)
+        if state.get("done") and "latest_text" not in state:
+            return
+        await asyncio.sleep(1.0)
+
+
+async def get_direct_link_cached(track_id: int, track_info) -> str | None:
+    cached = _direct_link_cache.get(track_id)
+    if cached is not None:
+        return cached
+
+    if hasattr(track_info, 'get_download_info_async'):
+        download_info = await track_info.get_download_info_async(get_direct_links=True)
+    else:
+        download_info = await asyncio.to_thread(lambda: track_info.get_download_info(get_direct_links=True))
+
+    # Один линейный проход: лучший битрейт без сортировки и промежуточного списка
+    best = max((di for di in download_info if di.codec == 'mp3' and di.direct_link),
+               key=lambda x: x.bitrate_in_kbps, default=None)
+    if best is None:
+        return None
+    direct_link = best.direct_link
+    _direct_link_cache[track_id] = direct_link
+    return direct_link
+
+
 async def download_file_aio(url: str, filename: str, chat_id: int, progress_msg_id: int) -> None:
+    state: Dict[str, Any] = {}
+    updated = asyncio.Event()
+    writer = asyncio.create_task(progress_writer(chat_id, progress_msg_id, state, updated))
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
+        async with DOWNLOAD_SEM:
+            async with http_session.get(url) as resp:
                 resp.raise_for_status()
                 total_size = int(resp.headers.get('Content-Length', 0) or 0)
+                total_mb = total_size * _MB
                 downloaded = 0
-                start_time = time.time()
+                # monotonic: дешевле time.time() и не прыгает при переводе часов
+                start_time = time.monotonic()
                 last_update = 0.0
-                with open(filename, 'wb') as f:
-                    async for chunk in resp.content.iter_chunked(8192):
+                last_pct = 0
+                # aiofiles: запись на диск уходит в тред-пул и не блокирует event loop.
+                # Открываем r+b и дописываем за ID3-тегом, который уже лежит в начале файла
+                async with aiofiles.open(filename, 'r+b') as f:
+                    tag_end = await f.seek(0, os.SEEK_END)
+                    if total_size > 0:
+                        try:
+                            # Преаллоцируем место под аудиопоток: без фрагментации
+                            # экстентов и обновления метаданных на каждую запись
+                            await asyncio.to_thread(os.posix_fallocate, f.fileno(), tag_end, total_size)
+                        except OSError:
+                            pass  # ФС не поддерживает fallocate — пишем как обычно
+                    async for chunk in resp.content.iter_chunked(256 * 1024):
                         if chunk:
-                            f.write(chunk)
+                            await f.write(chunk)
                             downloaded += len(chunk)
-                            current_time = time.time()
-
-                            if total_size > 0 and (current_time - last_update >= 1 or downloaded == total_size):
-                                last_update = current_time
-                                progress = int(downloaded / total_size * 100) if total_size > 0 else 0
-                                elapsed = current_time - start_time
-                                speed = (downloaded / (1024 * 1024)) / elapsed if elapsed > 0 else 0
-                                progress_text = (
-                                    f"Загрузка... {progress}%\n"
-                                    f"Скачано: {downloaded / (1024 * 1024):.2f}MB / {(total_size / (1024 * 1024)) if total_size > 0 else 0:.2f}MB\n"
-                                    f"Скорость: {speed:.2f} MB/s"
-                                )
-                                await edit_progress_message(chat_id, progress_msg_id, progress_text)
-    except:
-        await edit_progress_message(chat_id, progress_msg_id, f"Ошибка при загрузке файла")
+
+                            if total_size > 0:
+                                progress = downloaded * 100 // total_size
+                                # Сначала дешёвая целочисленная проверка процента; на часы
+                                # и форматирование идём, только если сдвиг заметный
+                                if progress - last_pct >= 5 or downloaded == total_size:
+                                    current_time = time.monotonic()
+                                    # >=5% И >=3с: не тратим лимит Telegram на прогресс-шум
+                                    if current_time - last_update >= 3 or downloaded == total_size:
+                                        last_update = current_time
+                                        last_pct = progress
+                                        elapsed = current_time - start_time
+                                        speed = downloaded * _MB / elapsed if elapsed > 0 else 0
+                                        progress_text = (
+                                            f"Загрузка... {progress}%\n"
+                                            f"Скачано: {downloaded * _MB:.2f}MB / {total_mb:.2f}MB\n"
+                                            f"Скорость: {speed:.2f} MB/s"
+                                        )
+                                        # писатель заберёт свежий текст сам — мы не ждём Telegram
+                                        state["latest_text"] = progress_text
+                                        updated.set()
+    except (aiohttp.ClientError, OSError, asyncio.TimeoutError):
+        logger.exception("Ошибка при загрузке %s", url)
+        state["latest_text"] = "Ошибка при загрузке файла"
+        updated.set()
+    finally:
+        state["done"] = True
+        updated.set()
+        await writer
 
 
 # === Новая функция: сохранение превью для Telegram ===
 def save_jpeg_thumb(cover_data: bytes) -> str:
-    fd, path = tempfile.mkstemp(suffix=".jpg", prefix="thumb_")
+    fd, path = tempfile.mkstemp(suffix=".jpg", prefix="thumb_", dir=CACHE_DIR)
     os.close(fd)
     try:
         img = Image.open(io.BytesIO(cover_data))
+        # draft: JPEG-источник декодируется сразу в уменьшенном масштабе
+        img.draft("RGB", (320, 320))
         img = img.convert("RGB")
-        img.thumbnail((320, 320), Image.LANCZOS)
-
-        for quality in (95, 85, 75, 65, 50):
-            buf = io.BytesIO()
-            img.save(buf, format="JPEG", quality=quality, optimize=True)
-            size = buf.tell()
-            if size <= 200 * 1024 or quality == 50:
-                with open(path, "wb") as f:
-                    f.write(buf.getvalue())
-                return path
-    except:
+        img.thumbnail((320, 320), Image.BICUBIC)
+        # Один прогон энкодера: 320x320 при q=85 почти всегда <30 КБ,
+        # прежний подбор качества по циклу кодировал до пяти раз впустую
+        img.save(path, format="JPEG", quality=85, optimize=True, progressive=True)
+        return path
+    except BaseException:
         try:
             if os.path.exists(path):
                 os.remove(path)
-        except:
+        except OSError:
             pass
         raise
 
@@ -208,43 +488,81 @@ def save_jpeg_thumb(cover_data: bytes) -> str:
 async def download_and_send_track(chat_id: int, track_id: int, progress_msg_id: int) -> None:
     temp_file = None
     temp_thumb = None
+    thumb_task = None
     try:
-        track_info = (await ym_client.tracks(track_id))[0]
+        # Трек уже отправляли раньше — переотправляем по file_id без скачивания и аплоада
+        cached_file_id = await asyncio.to_thread(get_cached_file_id, track_id)
+        if cached_file_id:
+            try:
+                await tg_bucket.acquire()
+                sent_audio = await safe_tg(lambda: bot.send_audio(chat_id=chat_id, audio=cached_file_id))
+            except TelegramBadRequest:
+                pass  # file_id мог протухнуть — скачиваем обычным путём
+            else:
+                spawn_bg(add_action_buttons(chat_id, sent_audio.message_id, ""))
+                spawn_bg(delete_message_silent(chat_id, progress_msg_id))
+                return
+
+        meta = _track_meta_cache.get(track_id)
+        if meta is not None:
+            track_info, cover_data = meta
+            cover_task = None
+        else:
+            track_info = (await ym_client.tracks(track_id))[0]
+            cover_url = f"https://{track_info.cover_uri.replace('%%', '400x400')}"
+            # Обложка и ссылки на скачивание не зависят друг от друга — тянем параллельно
+            cover_task = asyncio.create_task(fetch_cover(cover_url))
+
         artists = ", ".join(artist.name for artist in track_info.artists)
         title = track_info.title
 
         await edit_progress_message(chat_id, progress_msg_id, "Получение информации о треке...")
 
-        cover_url = f"https://{track_info.cover_uri.replace('%%', '400x400')}"
+        link_task = asyncio.create_task(get_direct_link_cached(track_id, track_info))
+        tmp_task = asyncio.create_task(
+            asyncio.to_thread(tempfile.mkstemp, suffix=".mp3", prefix=f"ym_{chat_id}_", dir=CACHE_DIR))
+        # return_exceptions: даже если обложка/ссылка упали, результат mkstemp
+        # нужно дождаться и зарегистрировать, иначе утекут fd и файл в tmpfs
+        if cover_task is not None:
+            results = await asyncio.gather(cover_task, link_task, tmp_task, return_exceptions=True)
+        else:
+            results = await asyncio.gather(link_task, tmp_task, return_exceptions=True)
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(cover_url) as resp:
-                resp.raise_for_status()
-                cover_data = await resp.read()
+        tmp_res = results[-1]
+        if not isinstance(tmp_res, BaseException):
+            fd, temp_path = tmp_res
+            os.close(fd)
+            temp_file = temp_path
 
-        try:
-            temp_thumb = save_jpeg_thumb(cover_data)
-        except:
-            temp_thumb = None
+        for res in results:
+            if isinstance(res, BaseException):
+                raise res
 
-        if hasattr(track_info, 'get_download_info_async'):
-            download_info = await track_info.get_download_info_async(get_direct_links=True)
+        if cover_task is not None:
+            cover_data, direct_link = results[0], results[1]
+            _track_meta_cache[track_id] = (track_info, cover_data)
         else:
-            download_info = await asyncio.to_thread(lambda: track_info.get_download_info(get_direct_links=True))
+            direct_link = results[0]
 
-        if not download_info:
-            pass
-        mp3_infos = [di for di in download_info if di.codec == 'mp3' and di.direct_link]
-        if not mp3_infos:
+        async def _make_thumb():
+            try:
+                # PIL-декод и ресайз — CPU-работа, уводим в тред, чтобы не морозить loop
+                return await asyncio.to_thread(save_jpeg_thumb, cover_data)
+            except Exception:
+                logger.exception("Не удалось подготовить превью для трека %s", track_id)
+                return None
+
+        # Превью готовится параллельно с записью тега и скачиванием mp3
+        thumb_task = asyncio.create_task(_make_thumb())
+
+        if not direct_link:
             await edit_progress_message(chat_id, progress_msg_id, "MP3 формат недоступен для этого трека. Попробуйте другой трек.")
             return
 
-        mp3_infos.sort(key=lambda x: x.bitrate_in_kbps, reverse=True)
-        direct_link = mp3_infos[0].direct_link
-
-        fd, temp_path = tempfile.mkstemp(suffix=".mp3", prefix=f"ym_{chat_id}_")
-        os.close(fd)
-        temp_file = temp_path
+        # Пишем ID3-тег в пустой файл ДО скачивания: mutagen кладёт заголовок с
+        # паддингом в начало, аудиопоток дописывается следом — без полной
+        # перезаписи готового mp3 после загрузки
+        await add_tags_to_audio(temp_path, title, artists, cover_data)
 
         await download_file_aio(direct_link, temp_path, chat_id, progress_msg_id)
 
@@ -253,61 +571,94 @@ async def download_and_send_track(chat_id: int, track_id: int, progress_msg_id:
             await edit_progress_message(chat_id, progress_msg_id, "Файл слишком большой для отправки как аудио (>50MB).")
             return
 
-        await add_tags_to_audio(temp_path, title, artists, cover_data)
+        temp_thumb = await thumb_task
 
         await edit_progress_message(chat_id, progress_msg_id, "Отправка трека...")
 
         try:
+            await tg_bucket.acquire()
+            # Крупные чанки при аплоаде: меньше итераций чтения файла на мегабайт
+            audio_file = FSInputFile(temp_path, chunk_size=1024 * 1024)
             if temp_thumb:
-                sent_audio = await bot.send_audio(
+                sent_audio = await safe_tg(lambda: bot.send_audio(
                     chat_id=chat_id,
-                    audio=FSInputFile(temp_path),
+                    audio=audio_file,
                     title=title,
                     performer=artists,
-                    thumbnail=FSInputFile(temp_thumb)
-                )
+                    thumbnail=FSInputFile(temp_thumb, chunk_size=1024 * 1024)
+                ))
             else:
-                sent_audio = await bot.send_audio(
+                sent_audio = await safe_tg(lambda: bot.send_audio(
                     chat_id=chat_id,
-                    audio=FSInputFile(temp_path),
+                    audio=audio_file,
                     title=title,
                     performer=artists
-                )
+                ))
+
+            if sent_audio.audio:
+                await asyncio.to_thread(save_file_id, track_id, sent_audio.audio.file_id)
 
-            await add_action_buttons(chat_id, sent_audio.message_id, title)
-        except:
+            # Не ждём Telegram: воркер сразу освобождается под следующий трек
+            spawn_bg(add_action_buttons(chat_id, sent_audio.message_id, title))
+        except Exception:
+            logger.exception("Ошибка при отправке трека %s в чат %s", track_id, chat_id)
             await edit_progress_message(chat_id, progress_msg_id, f"Ошибка при отправке трека")
             return
 
-        try:
-            await bot.delete_message(chat_id, progress_msg_id)
-        except:
-            pass
+        spawn_bg(delete_message_silent(chat_id, progress_msg_id))
 
-    except:
+    except Exception:
+        logger.exception("Ошибка при обработке трека %s для чата %s", track_id, chat_id)
         await edit_progress_message(chat_id, progress_msg_id, f"Общая ошибка")
     finally:
+        # При ошибке до await thumb_task дожидаемся его, чтобы не потерять файл превью
+        if temp_thumb is None and thumb_task is not None:
+            temp_thumb = await thumb_task
         if temp_file and os.path.exists(temp_file):
             try:
                 os.remove(temp_file)
-            except:
+            except OSError:
                 pass
         if temp_thumb and os.path.exists(temp_thumb):
             try:
                 os.remove(temp_thumb)
-            except:
+            except OSError:
                 pass
 
 
-async def download_worker():
+async def _run_download(task, release_normal: bool) -> None:
+    # Слоты уже взяты диспетчером — здесь только работа и освобождение
+    try:
+        await download_and_send_track(*task)
+    except Exception:
+        logger.exception("Необработанная ошибка в задаче загрузки")
+    finally:
+        download_slots.release()
+        if release_normal:
+            normal_slots.release()
+
+
+async def _dispatch_loop(queue: collections.deque, event: asyncio.Event, needs_normal_slot: bool) -> None:
+    # Слот берётся ДО снятия задачи с очереди, поэтому параллелизм ограничен
+    # ещё на этапе диспетчеризации, а не внутри запущенных задач
     while True:
-        priority, task = await download_queue.get()
-        try:
-            await download_and_send_track(*task)
-        except:
-            pass
-        finally:
-            download_queue.task_done()
+        while not queue:
+            event.clear()
+            await event.wait()
+        if needs_normal_slot:
+            await normal_slots.acquire()
+        await download_slots.acquire()
+        task = queue.popleft()
+        asyncio.create_task(_run_download(task, release_normal=needs_normal_slot))
+
+
+async def download_dispatcher():
+    # Отдельный диспетчер на каждую очередь: ожидание обычного слота никогда
+    # не блокирует выдачу зарезервированных слотов подписчикам
+    await asyncio.gather(
+        _dispatch_loop(prio_queue, prio_event, needs_normal_slot=False),
+        _dispatch_loop(norm_queue, norm_event, needs_normal_slot=True),
+    )
 
 
 # === ОБРАБОТЧИКИ КОМАНД И СООБЩЕНИЙ AIОGRAM ===
@@ -326,7 +677,7 @@ async def send_welcome(message: Message):
 @dp.message(Command("status"))
 async def status_handler(message: Message):
     chat_id = message.chat.id
-    days_left = get_subscription_days_left(chat_id)
+    days_left = await asyncio.to_thread(get_subscription_days_left, chat_id)
     await message.answer(f"Ваш user_id: {chat_id}\nОсталось дней подписки: {days_left} дней")
 
 
@@ -334,7 +685,7 @@ async def status_handler(message: Message):
 @dp.message(Command("subscribe"))
 async def subscribe_handler(message: Message):
     chat_id = message.chat.id
-    days_left = get_subscription_days_left(chat_id)
+    days_left = await asyncio.to_thread(get_subscription_days_left, chat_id)
     if days_left > 0:
         await message.answer(
             f"У вас уже есть подписка.\n\nОсталось: {days_left} дней.\n\nПосле оплаты к текущей подписке добавится ещё {SUBSCRIBE_DURATION_DAYS} дней.")
@@ -343,6 +694,7 @@ async def subscribe_handler(message: Message):
         amount = SUBSCRIBE_PRICE_STARS
         prices = [LabeledPrice(label="Подписка", amount=amount)]
 
+        await tg_bucket.acquire()
         invoice_msg = await bot.send_invoice(
             chat_id=chat_id,
             title=f"Подписка на {SUBSCRIBE_DURATION_DAYS} дней",
@@ -356,7 +708,8 @@ async def subscribe_handler(message: Message):
 
         invoices[chat_id] = invoice_msg.message_id
 
-    except:
+    except Exception:
+        logger.exception("Не удалось выставить счёт для чата %s", chat_id)
         await message.answer("Не удалось создать счёт для оплаты. Пожалуйста, попробуйте позже.")
 
 
@@ -370,15 +723,13 @@ async def successful_payment_handler(message: Message):
     chat_id = message.chat.id
     if chat_id in invoices:
         try:
-            await bot.delete_message(chat_id, invoices[chat_id])
-        except:
-            pass
+            await delete_message_silent(chat_id, invoices[chat_id])
         finally:
             invoices.pop(chat_id, None)
 
     if message.successful_payment and message.successful_payment.invoice_payload == "subscribe_30d":
-        add_subscription(chat_id, days=SUBSCRIBE_DURATION_DAYS)
-        days_left = get_subscription_days_left(chat_id)
+        await asyncio.to_thread(add_subscription, chat_id, SUBSCRIBE_DURATION_DAYS)
+        days_left = await asyncio.to_thread(get_subscription_days_left, chat_id)
         await message.answer(
             f"Спасибо за оплату! Ваша подписка оформлена.\n\nОсталось {days_left} дней.")
     else:
@@ -397,19 +748,24 @@ async def perform_search_and_show(message: Message, query: str):
     try:
         # удаляем старое сообщение с выбором, если было
         if chat_id in user_states and "select_msg" in user_states[chat_id]:
-            try:
-                await bot.delete_message(chat_id, user_states[chat_id]["select_msg"].message_id)
-            except:
-                pass
+            await delete_message_silent(chat_id, user_states[chat_id]["select_msg"].message_id)
 
-        # используем query вместо message.text
-        search_result = await ym_client.search(query, type_="track")
+        cache_key = query.strip().lower()
+        tracks = search_cache.get(cache_key)
+        if tracks is None:
+            # используем query вместо message.text
+            search_result = await ym_client.search(query, type_="track")
 
-        if not getattr(search_result, 'tracks', None) or not getattr(search_result.tracks, 'results', None):
+            if not getattr(search_result, 'tracks', None) or not getattr(search_result.tracks, 'results', None):
+                tracks = []
+            else:
+                tracks = search_result.tracks.results[:5]
+            search_cache[cache_key] = tracks
+
+        if not tracks:
             await message.answer("Ничего не найдено. Попробуйте изменить запрос.")
             return
 
-        tracks = search_result.tracks.results[:5]
         inline_keyboard = []
         for track in tracks:
             if not getattr(track, 'available', True):
@@ -425,7 +781,8 @@ async def perform_search_and_show(message: Message, query: str):
         else:
             await message.answer("Найденные треки недоступны для загрузки.")
 
-    except:
+    except Exception:
+        logger.exception("Ошибка при поиске по запросу %r", query)
         await message.answer("Произошла ошибка при поиске. Попробуйте позже.")
 
 
@@ -493,23 +850,28 @@ async def download_callback_handler(callback: CallbackQuery):
     try:
         track_id = int(callback.data.split("_")[1])
 
-        priority = 0 if is_subscribed(chat_id) else 1
+        priority = 0 if await asyncio.to_thread(is_subscribed, chat_id) else 1
 
-        try:
-            await bot.delete_message(chat_id, callback.message.message_id)
-        except:
-            pass
+        await delete_message_silent(chat_id, callback.message.message_id)
 
+        await tg_bucket.acquire()
         progress_msg = await bot.send_message(chat_id, "Ваш запрос добавлен в очередь...")
 
-        await download_queue.put((priority, (chat_id, track_id, progress_msg.message_id)))
+        task = (chat_id, track_id, progress_msg.message_id)
+        if priority == 0:
+            prio_queue.append(task)
+            prio_event.set()
+        else:
+            norm_queue.append(task)
+            norm_event.set()
 
         if priority == 0:
             await callback.answer("Приоритетная загрузка началась!")
         else:
             await callback.answer("Загрузка началась...")
 
-    except:
+    except Exception:
+        logger.exception("Ошибка при постановке трека в очередь")
         await callback.answer("Ошибка при добавлении в очередь загрузки.")
 
 
@@ -517,27 +879,38 @@ async def download_callback_handler(callback: CallbackQuery):
 async def delete_track_handler(callback: CallbackQuery):
     try:
         message_id_to_delete = int(callback.data.split("_")[1])
-        await bot.delete_message(callback.message.chat.id, message_id_to_delete)
+        await tg_bucket.acquire()
+        await safe_tg(lambda: bot.delete_message(callback.message.chat.id, message_id_to_delete))
         await callback.answer("Трек удалён.")
-    except:
+    except TelegramRetryAfter as e:
+        # 429 и после повтора в safe_tg — ставим bucket на паузу и отвечаем,
+        # чтобы спиннер на кнопке не висел
+        await tg_bucket.pause(e.retry_after)
+        await callback.answer("Не удалось удалить трек. Попробуйте позже.")
+    except (TelegramBadRequest, ValueError):
         await callback.answer("Не удалось удалить трек (возможно, он уже удалён).")
 
 
 # === ЗАПУСК БОТА ===
 async def main():
-    global ym_client, BOT_ID
-    init_db()
+    global ym_client, BOT_ID, http_session
+    logging.basicConfig(level=logging.INFO)
     ym_client = ClientAsync(YM_TOKEN)
-    await ym_client.init()
-    # Инициализируем информацию о боте (чтобы знать его id и не отвечать на собственные сообщения)
-    me = await bot.get_me()
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=64, limit_per_host=16, ttl_dns_cache=300, keepalive_timeout=60),
+        read_bufsize=1024 * 1024,  # StreamReader отдаёт крупные склеенные чанки за один вызов
+    )
+    # БД, клиент Яндекса и get_me (id бота для проверки reply_to_message)
+    # независимы — поднимаем параллельно, чтобы ускорить холодный старт
+    _, _, me = await asyncio.gather(asyncio.to_thread(init_db), ym_client.init(), bot.get_me())
     BOT_ID = me.id
     print("Running!")
-    for _ in range(MAX_CONCURRENT_DOWNLOADS):
-        asyncio.create_task(download_worker())
+    asyncio.create_task(sub_cache_evictor())
+    asyncio.create_task(download_dispatcher())
     try:
         await dp.start_polling(bot)
     finally:
+        await http_session.close()
         await bot.session.close()
 
 